@@ -4,17 +4,41 @@
 from __future__ import annotations
 
 import errno
-import glob
 import hashlib
 import io
+import mmap
 import os
-import shutil
+import stat
+import threading
+from collections import OrderedDict
 from contextlib import closing
 from dataclasses import dataclass
 from tempfile import NamedTemporaryFile
-from typing import BinaryIO, Callable
+from typing import BinaryIO, Callable, Iterable, Iterator, Protocol, TextIO
 
-from .utils import issubdir, shard
+from .utils import imap_unordered, make_shard
+
+#: Size of the chunks read from streams when hashing and copying. A multiple
+#: of every common filesystem block size, large enough to amortize per-read
+#: overhead and small enough to stay cache friendly with many concurrent
+#: readers.
+CHUNK_SIZE = 1024 * 1024
+
+#: When :attr:`EverCas.use_mmap` is set, files at least this large are memory
+#: mapped and hashed in a single call instead of being read chunk by chunk.
+#: Mapping already wins for files of a single chunk.
+MMAP_THRESHOLD = CHUNK_SIZE
+
+#: Maximum number of bytes copied per ``os.sendfile`` call.
+SENDFILE_SIZE = 8 * 1024 * 1024
+
+#: Name of the folder under :attr:`EverCas.root` that files are staged in
+#: before being moved to their address. It is never listed as stored content.
+STAGING_DIRNAME = ".tmp"
+
+# File object types whose read() returns the raw bytes of the file behind
+# their fileno(), so that the file can be mapped or copied by descriptor.
+_PLAIN_FILE_TYPES = (io.FileIO, io.BufferedReader, io.BufferedRandom)
 
 
 class EverCas(object):
@@ -40,11 +64,24 @@ class EverCas(object):
             to :attr:`PutStrategies.copy`.
         lowercase_extensions (bool, optional): Normalize all file extensions
             to lower case when adding files. Defaults to ``False``.
+        lookup_cache_size (int, optional): Number of ids whose location is
+            remembered after a successful lookup, so that repeated
+            :meth:`get`, :meth:`exists` and :meth:`open` calls for the same
+            id don't hit the filesystem. Files removed behind this
+            instance's back are not noticed until :meth:`clear_lookup_cache`
+            is called. Defaults to ``0`` (disabled).
+        use_mmap (bool, optional): Hash regular files of at least
+            :data:`MMAP_THRESHOLD` bytes from a memory map in a single call
+            instead of reading them chunk by chunk. This is faster, but if
+            another process truncates a file while it is being hashed, the
+            interpreter is killed with ``SIGBUS``; only enable it when files
+            being put or checked aren't modified concurrently. Defaults to
+            ``False``.
     """
 
     def __init__(
         self,
-        root: str,
+        root: str | os.PathLike[str],
         depth: int = 4,
         width: int = 1,
         algorithm: str = "sha256",
@@ -52,19 +89,87 @@ class EverCas(object):
         dmode: int = 0o755,
         put_strategy: str | None = None,
         lowercase_extensions: bool = False,
+        lookup_cache_size: int = 0,
+        use_mmap: bool = False,
     ):
-        self.root = os.path.realpath(root)
-        self.depth = depth
-        self.width = width
+        self.root: str = os.path.realpath(os.fspath(root))
+        self._root_prefix = self.root + os.sep
+        self._staging = os.path.join(self.root, STAGING_DIRNAME)
+        self._depth = depth
+        self._width = width
+        self._shard = make_shard(depth, width)
         self.algorithm = algorithm
         self.fmode = fmode
         self.dmode = dmode
         self.put_strategy = PutStrategies.get(put_strategy) or PutStrategies.copy
         self.lowercase_extensions = lowercase_extensions
+        self._lookup_cache: OrderedDict[str, str] | None = None
+        self._lookup_lock = threading.Lock()
+        self.lookup_cache_size = lookup_cache_size
+        self.use_mmap = use_mmap
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    @depth.setter
+    def depth(self, depth: int):
+        self._depth = depth
+        self._shard = make_shard(depth, self._width)
+
+    @property
+    def width(self) -> int:
+        return self._width
+
+    @width.setter
+    def width(self, width: int):
+        self._width = width
+        self._shard = make_shard(self._depth, width)
+
+    @property
+    def algorithm(self) -> str:
+        return self._algorithm
+
+    @algorithm.setter
+    def algorithm(self, algorithm: str):
+        # Resolving an algorithm name goes through hashlib's constructor
+        # lookup; do it once here and hand out copies of a pristine hash
+        # object from newhash() instead.
+        self._hash_prototype = hashlib.new(algorithm)
+        self._algorithm = algorithm
+
+    @property
+    def lookup_cache_size(self) -> int:
+        return self._lookup_cache_size
+
+    @lookup_cache_size.setter
+    def lookup_cache_size(self, lookup_cache_size: int):
+        with self._lookup_lock:
+            self._lookup_cache_size = lookup_cache_size
+            if lookup_cache_size <= 0:
+                self._lookup_cache = None
+            elif self._lookup_cache is None:
+                self._lookup_cache = OrderedDict()
+            else:
+                # Drop the least recently used ids that no longer fit.
+                while len(self._lookup_cache) > lookup_cache_size:
+                    self._lookup_cache.popitem(last=False)
+
+    def clear_lookup_cache(self):
+        """Forget all ids remembered by :meth:`realpath`. Needed after files
+        are removed or moved without going through this instance.
+        """
+        if self._lookup_cache is not None:
+            with self._lookup_lock:
+                self._lookup_cache.clear()
+
+    def newhash(self):
+        """Return a new, empty hash object for :attr:`algorithm`."""
+        return self._hash_prototype.copy()
 
     def put(
         self,
-        file: BinaryIO | str,
+        file: BinaryIO | TextIO | str,
         extension: str | None = None,
         put_strategy: str | None = None,
         simulate: bool = False,
@@ -95,6 +200,14 @@ class EverCas(object):
         the platform and underlying filesystem support it, and falls back to
         "copy" behavior.
 
+        Copying puts hash the data while writing it to a temporary file in
+        the staging folder, so a file that is already stored is still written
+        once before being discarded. That costs write bandwidth and needs free
+        space for a full copy, which can fail with ``ENOSPC`` even though
+        nothing new would be stored. For ingests with many duplicates, prefer
+        the "link" strategy for files with a path, or check with
+        ``simulate=True`` first.
+
         Returns:
             HashAddress: File's hash address.
         """
@@ -103,23 +216,46 @@ class EverCas(object):
         if extension and self.lowercase_extensions:
             extension = extension.lower()
 
+        put_strategy_callable = (
+            PutStrategies.get(put_strategy) or self.put_strategy or PutStrategies.copy
+        )
+
+        # Strategies that end up copying the data have to read the whole file
+        # anyway, so hash it while staging the copy instead of reading twice.
+        # The link strategy can only link streams that have a path.
+        stages_copy = put_strategy_callable is PutStrategies.copy or (
+            put_strategy_callable == PutStrategies.link and not stream.name
+        )
+
         with closing(stream):
-            id = self.computehash(stream)
+            if stages_copy and not simulate:
+                id, tmppath = self._hashandstage(stream)
+            else:
+                tmppath = None
+                id = self.computehash(stream)
+
             filepath = self.idpath(id, extension)
 
-            # Only move file if it doesn't already exist.
-            if not os.path.isfile(filepath):
-                is_duplicate = False
-                if not simulate:
+            if tmppath is not None:
+                try:
+                    is_duplicate = self._placefile(tmppath, filepath)
+                finally:
+                    # The temp file is normally still there after being
+                    # linked into place, so remove it without checking first.
+                    try:
+                        os.remove(tmppath)
+                    except FileNotFoundError:
+                        pass
+            else:
+                # Only move file if it doesn't already exist.
+                try:
+                    is_duplicate = stat.S_ISREG(os.stat(filepath).st_mode)
+                except (FileNotFoundError, NotADirectoryError):
+                    is_duplicate = False
+
+                if not is_duplicate and not simulate:
                     self.makepath(os.path.dirname(filepath))
-                    put_strategy_callable = (
-                        PutStrategies.get(put_strategy)
-                        or self.put_strategy
-                        or PutStrategies.copy
-                    )
                     put_strategy_callable(self, stream, filepath)
-            else:
-                is_duplicate = True
 
         return HashAddress(id, self.relpath(filepath), filepath, is_duplicate)
 
@@ -130,6 +266,7 @@ class EverCas(object):
         recursive: bool = False,
         put_strategy: str | None = None,
         simulate: bool = False,
+        max_workers: int | None = None,
     ):
         """Put all files from a directory.
 
@@ -142,35 +279,132 @@ class EverCas(object):
                 Defaults to ``False``.
             put_strategy (mixed, optional): same as :meth:`put`.
             simulate (boo, optional): same as :meth:`put`.
+            max_workers (int, optional): Maximum number of files to put at
+                once. Defaults to ``min(32, os.cpu_count() + 4)``.
 
-        Yields :class:`HashAddress`es for all added files.
+        Yields ``(path, address)`` tuples of every source file path and its
+        :class:`HashAddress`. Files are put concurrently, so they are yielded
+        in the order they finish rather than in directory order.
         """
-        for file in find_files(root, recursive=recursive):
+
+        def putfile(file: str):
             extension = os.path.splitext(file)[1] if extensions else None
             address = self.put(
                 file, extension=extension, put_strategy=put_strategy, simulate=simulate
             )
-            yield (file, address)
+            return (file, address)
+
+        return imap_unordered(
+            putfile, find_files(root, recursive=recursive), max_workers=max_workers
+        )
 
-    def mktempfile(self, stream: Stream):
+    def mktempfile(
+        self,
+        stream: Stream,
+        dir: str | None = None,
+        hashobj: HashObject | None = None,
+    ):
         """Create a named temporary file from a :class:`Stream` object and
         return its filename.
-        """
-        tmp = NamedTemporaryFile(delete=False)
 
-        oldmask = os.umask(0)
+        Args:
+            stream (Stream): Data to write to the temporary file.
+            dir (str, optional): Directory to create the temporary file in.
+                Creating it on the same filesystem as its final destination
+                allows it to be renamed into place instead of copied.
+                Defaults to the system temporary directory.
+            hashobj (hashlib hash, optional): Hash object to update with the
+                data as it is written, so the content hash can be computed
+                without reading `stream` a second time.
+        """
+        tmp = NamedTemporaryFile(delete=False, dir=dir)
 
         try:
-            os.chmod(tmp.name, self.fmode)
-        finally:
-            os.umask(oldmask)
+            if hasattr(os, "fchmod"):
+                os.fchmod(tmp.fileno(), self.fmode)
+            else:  # pragma: no cover
+                os.chmod(tmp.name, self.fmode)
+
+            fileno = stream.fileno() if hashobj is None else None
+
+            # Without a hash to feed, plain regular files can be copied inside
+            # the kernel instead of through Python buffers. Stream.fileno()
+            # is None for anything else, such as decompressing wrappers.
+            if fileno is None or not copyfd(fileno, tmp.fileno()):
+                for data in stream:
+                    if hashobj is not None:
+                        hashobj.update(data)
+                    tmp.write(data)
+
+            tmp.close()
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
 
-        for data in stream:
-            tmp.write(to_bytes(data))
+        return tmp.name
 
-        tmp.close()
+    def mkstagedfile(self, stream: Stream, hashobj: HashObject | None = None):
+        """Create a named temporary file from a :class:`Stream` object in the
+        staging folder (:data:`STAGING_DIRNAME`) and return its filename.
 
-        return tmp.name
+        The staging folder lives under the :attr:`root` directory, so staged
+        files can be renamed or linked into place, but it is skipped when
+        listing stored files; in-progress and abandoned copies never show up
+        as content.
+
+        Args:
+            stream (Stream): Data to write to the temporary file.
+            hashobj (hashlib hash, optional): same as :meth:`mktempfile`.
+        """
+        try:
+            return self.mktempfile(stream, dir=self._staging, hashobj=hashobj)
+        except FileNotFoundError:
+            # Only create the folder once it turns out to be missing.
+            self.makepath(self._staging)
+            return self.mktempfile(stream, dir=self._staging, hashobj=hashobj)
+
+    def _hashandstage(self, stream: Stream):
+        """Copy `stream` to a staged temporary file while hashing it. Return
+        ``(id, tmppath)``.
+        """
+        hashobj = self.newhash()
+        tmppath = self.mkstagedfile(stream, hashobj=hashobj)
+        return hashobj.hexdigest(), tmppath
+
+    def _placefile(self, tmppath: str, filepath: str):
+        """Store the staged file `tmppath` at `filepath` unless a file is
+        already stored there. Return whether `filepath` already existed.
+
+        Hard linking doubles as an atomic existence check: it fails with
+        ``EEXIST`` instead of replacing the destination, so no separate
+        ``stat`` is needed and concurrent puts of the same content agree on
+        which one stored it. `tmppath` is left for the caller to remove.
+        """
+        if hasattr(os, "link"):
+            try:
+                try:
+                    os.link(tmppath, filepath)
+                except FileNotFoundError:
+                    # Only create the shard folder once it turns out to be
+                    # missing, rather than checking for it on every put.
+                    self.makepath(os.path.dirname(filepath))
+                    os.link(tmppath, filepath)
+            except FileExistsError:
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise
+            else:
+                return False
+
+        # No hard link support; check first and rename instead.
+        if os.path.isfile(filepath):
+            return True
+
+        self.makepath(os.path.dirname(filepath))
+        os.replace(tmppath, filepath)
+        return False
 
     def get(self, file: str):
         """Return :class:`HashAddress` from given id or path. If `file` does not
@@ -219,6 +453,19 @@ class EverCas(object):
         if realpath is None:
             return
 
+        cache = self._lookup_cache
+        if cache is not None:
+            # Only the file's id, with or without its extension, can have been
+            # remembered for this path, so forget just those.
+            keys = [file]
+            if self.haspath(realpath):
+                id = self.unshard(realpath)
+                keys += [id, id + os.path.splitext(realpath)[1]]
+            with self._lookup_lock:
+                for key in keys:
+                    if cache.get(key) == realpath:
+                        del cache[key]
+
         try:
             os.remove(realpath)
         except OSError:  # pragma: no cover
@@ -231,49 +478,89 @@ class EverCas(object):
         proceeding "up" through directory tree until reaching the :attr:`root`
         folder.
         """
-        # Don't attempt to remove any folders if subpath is not a
-        # subdirectory of the root directory.
-        if not self.haspath(subpath):
-            return
-
-        while subpath != self.root:
-            if len(os.listdir(subpath)) > 0 or os.path.islink(subpath):
+        # Resolve symlinks first so that a link inside the store can't lead
+        # to folders outside of it; nothing is removed unless the resolved
+        # path is a subdirectory of the root directory.
+        subpath = os.path.realpath(subpath)
+
+        while subpath.startswith(self._root_prefix):
+            # rmdir already refuses non-empty directories and symlinks, so
+            # let it do the checking instead of listing each directory.
+            try:
+                os.rmdir(subpath)
+            except OSError:
                 break
-            os.rmdir(subpath)
             subpath = os.path.dirname(subpath)
 
     def files(self):
         """Return generator that yields all files in the :attr:`root`
         directory.
         """
-        for file in find_files(self.root, recursive=True):
-            yield os.path.abspath(file)
+        # root is absolute and normalized, so are the paths under it.
+        for entry in self._scanfiles():
+            yield entry.path
+
+    def _scanfiles(self) -> Iterator[os.DirEntry[str]]:
+        """Return generator that yields an ``os.DirEntry`` for every stored
+        file, skipping the staging folder.
+        """
+        try:
+            it = os.scandir(self.root)
+        except OSError:
+            return
+
+        with it:
+            for entry in it:
+                if entry.is_file():
+                    yield entry
+                elif (
+                    entry.is_dir(follow_symlinks=False)
+                    and entry.name != STAGING_DIRNAME
+                ):
+                    yield from scan_files(entry.path, recursive=True)
 
     def folders(self):
         """Return generator that yields all folders in the :attr:`root`
         directory that contain files.
         """
-        for folder, _, files in os.walk(self.root):
+        for folder, dirs, files in os.walk(self.root):
+            if folder == self.root and STAGING_DIRNAME in dirs:
+                dirs.remove(STAGING_DIRNAME)
             if files:
                 yield folder
 
     def count(self):
         """Return count of the number of files in the :attr:`root` directory."""
-        count = 0
-        for _ in self:
-            count += 1
-        return count
+        return sum(1 for _ in self._scanfiles())
 
-    def size(self):
+    def size(self, max_workers: int | None = None):
         """Return the total size in bytes of all files in the :attr:`root`
         directory.
+
+        Args:
+            max_workers (int, optional): Maximum number of top level folders
+                to walk at once. Defaults to
+                ``min(32, os.cpu_count() + 4)``.
         """
         total = 0
+        folders: list[str] = []
 
-        for path in self.files():
-            total += os.path.getsize(path)
-
-        return total
+        try:
+            with os.scandir(self.root) as it:
+                for entry in it:
+                    if entry.is_file():
+                        total += entry.stat().st_size
+                    elif (
+                        entry.is_dir(follow_symlinks=False)
+                        and entry.name != STAGING_DIRNAME
+                    ):
+                        folders.append(entry.path)
+        except FileNotFoundError:
+            return 0
+
+        # Each top level shard folder is an independent subtree; stat calls
+        # release the GIL, so walking them concurrently overlaps the I/O.
+        return total + sum(imap_unordered(folder_size, folders, max_workers))
 
     def exists(self, file: str):
         """Check whether a given file id or path exists on disk."""
@@ -283,7 +570,10 @@ class EverCas(object):
         """Return whether `path` is a subdirectory of the :attr:`root`
         directory.
         """
-        return issubdir(path, self.root)
+        # Symlinks inside the store may point anywhere, so `path` has to be
+        # resolved even when it is spelled under the root. The root itself
+        # was resolved once on creation.
+        return os.path.realpath(path).startswith(self._root_prefix)
 
     def makepath(self, path: str):
         """Physically create the folder path on disk."""
@@ -294,6 +584,10 @@ class EverCas(object):
 
     def relpath(self, path: str):
         """Return `path` relative to the :attr:`root` directory."""
+        # Paths handed out by this class are normalized and start with the
+        # root, so slicing off the prefix is enough for them.
+        if path.startswith(self._root_prefix) and os.path.normpath(path) == path:
+            return path[len(self._root_prefix) :]
         return os.path.relpath(path, self.root)
 
     def realpath(self, file: str):
@@ -301,8 +595,18 @@ class EverCas(object):
         successive checking of candidate paths. If the real path is stored with
         an extension, the path is considered a match if the basename matches
         the expected file path of the id.
+
+        If :attr:`lookup_cache_size` is set, ids found through their sharded
+        path are remembered so that repeated lookups skip the filesystem.
         """
 
+        cache = self._lookup_cache
+        if cache is not None:
+            with self._lookup_lock:
+                if file in cache:
+                    cache.move_to_end(file)
+                    return cache[file]
+
         # Check for absolute path.
         if os.path.isfile(file):
             return file
@@ -312,15 +616,34 @@ class EverCas(object):
         if os.path.isfile(relpath):
             return relpath
 
+        filepath = self._idrealpath(file)
+
+        if filepath is not None and cache is not None:
+            with self._lookup_lock:
+                cache[file] = filepath
+                if len(cache) > self.lookup_cache_size:
+                    cache.popitem(last=False)
+
+        return filepath
+
+    def _idrealpath(self, id: str):
         # Check for sharded path.
-        filepath = self.idpath(file)
+        filepath = self.idpath(id)
         if os.path.isfile(filepath):
             return filepath
 
-        # Check for sharded path with any extension.
-        paths = glob.glob("{0}.*".format(filepath))
-        if paths:
-            return paths[0]
+        # Check for sharded path with any extension. Scan the shard folder
+        # directly rather than through glob, which would also interpret any
+        # wildcard characters in the root path.
+        folder, name = os.path.split(filepath)
+        prefix = name + os.extsep
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.name.startswith(prefix) and entry.is_file():
+                        return entry.path
+        except OSError:
+            pass
 
         # Could not determine a match.
         return None
@@ -336,18 +659,29 @@ class EverCas(object):
         elif not extension:
             extension = ""
 
-        return os.path.join(self.root, *paths) + extension
+        # A single str.join is an order of magnitude cheaper than
+        # os.path.join, and shard components never contain separators.
+        return self._root_prefix + os.sep.join(paths) + extension
 
     def computehash(self, stream: Stream):
         """Compute hash of file using :attr:`algorithm`."""
-        hashobj = hashlib.new(self.algorithm)
-        for data in stream:
-            hashobj.update(to_bytes(data))
+        hashobj = self.newhash()
+        mapped = stream.mmap() if self.use_mmap else None
+
+        if mapped is not None:
+            # Hand the whole file to the hash object in one call; it digests
+            # the mapping without copying it into bytes chunk by chunk.
+            with mapped:
+                hashobj.update(mapped)
+        else:
+            for data in stream:
+                hashobj.update(data)
+
         return hashobj.hexdigest()
 
     def shard(self, id: str):
         """Shard content ID into subfolders."""
-        return shard(id, self.depth, self.width)
+        return self._shard(id)
 
     def unshard(self, path: str):
         """Unshard path to determine hash value."""
@@ -359,12 +693,20 @@ class EverCas(object):
 
         return os.path.splitext(self.relpath(path))[0].replace(os.sep, "")
 
-    def repair(self, extensions: bool = True):
+    def repair(self, extensions: bool = True, max_workers: int | None = None):
         """Repair any file locations whose content address doesn't match it's
         file path.
+
+        Args:
+            extensions (bool, optional): Whether to keep file extensions when
+                moving files. Defaults to ``True``.
+            max_workers (int, optional): same as :meth:`corrupted`.
         """
         repaired: list[tuple[str, HashAddress]] = []
-        corrupted = tuple(self.corrupted(extensions=extensions))
+        corrupted = tuple(
+            self.corrupted(extensions=extensions, max_workers=max_workers)
+        )
+        self.clear_lookup_cache()
         oldmask = os.umask(0)
 
         try:
@@ -375,7 +717,7 @@ class EverCas(object):
                 else:
                     # File doesn't exists so move it.
                     self.makepath(os.path.dirname(address.abspath))
-                    shutil.move(path, address.abspath)
+                    os.replace(path, address.abspath)
 
                 os.chmod(address.abspath, self.fmode)
                 repaired.append((path, address))
@@ -384,17 +726,21 @@ class EverCas(object):
 
         return repaired
 
-    def corrupted(self, extensions: bool = True):
+    def corrupted(self, extensions: bool = True, max_workers: int | None = None):
         """Return generator that yields corrupted files as ``(path, address)``
         where ``path`` is the path of the corrupted file and ``address`` is
         the :class:`HashAddress` of the expected location.
-        """
-        for path in self.files():
-            stream = Stream(path)
 
-            with closing(stream):
-                id = self.computehash(stream)
+        Files are hashed concurrently, so results are yielded in the order
+        their hashes complete rather than in directory order.
 
+        Args:
+            extensions (bool, optional): Whether to keep file extensions when
+                computing the expected location. Defaults to ``True``.
+            max_workers (int, optional): Maximum number of files to hash at
+                once. Defaults to ``min(32, os.cpu_count() + 4)``.
+        """
+        for path, id in self.computehashes(self.files(), max_workers=max_workers):
             extension = os.path.splitext(path)[1] if extensions else None
             expected_path = self.idpath(id, extension)
 
@@ -404,6 +750,20 @@ class EverCas(object):
                     HashAddress(id, self.relpath(expected_path), expected_path),
                 )
 
+    def computehashes(self, paths: Iterable[str], max_workers: int | None = None):
+        """Return generator that yields ``(path, id)`` for every file path in
+        `paths`, hashing up to `max_workers` files at once in a thread pool.
+        Results are yielded as soon as they are ready, so their order is not
+        guaranteed to match `paths`.
+        """
+        return imap_unordered(self._computefilehash, paths, max_workers=max_workers)
+
+    def _computefilehash(self, path: str):
+        stream = Stream(path)
+
+        with closing(stream):
+            return path, self.computehash(stream)
+
     def __contains__(self, file: str):
         """Return whether a given file id or path is contained in the
         :attr:`root` directory.
@@ -420,26 +780,71 @@ class EverCas(object):
 
 
 def find_files(path: str, recursive: bool = False):
-    if recursive:
-        for folder, _, files in os.walk(path):
-            for file in files:
-                yield os.path.join(folder, file)
-    else:
-        for file in list_dir_files(path):
-            yield file
-
-
-def list_dir_files(path: str):
-    it = os.scandir(path)
-    try:
-        for file in it:
-            if file.is_file():
-                yield file.path
-    finally:
+    for entry in scan_files(path, recursive=recursive):
+        yield entry.path
+
+
+def scan_files(path: str, recursive: bool = False) -> Iterator[os.DirEntry[str]]:
+    """Return generator that yields an ``os.DirEntry`` for every file in
+    `path`, descending into subdirectories if `recursive` is set.
+
+    Entries come straight from ``os.scandir``, so callers can check their
+    type (and, on Windows, their size) without another ``stat`` call. Like
+    ``os.walk``, unreadable directories are skipped when recursing.
+    """
+    stack = [path]
+
+    while stack:
         try:
-            it.close()
-        except AttributeError:
-            pass
+            it = os.scandir(stack.pop())
+        except OSError:
+            if not recursive:
+                raise
+            continue
+
+        with it:
+            for entry in it:
+                if entry.is_file():
+                    yield entry
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+
+def folder_size(path: str):
+    """Return the total size in bytes of all files in `path` and its
+    subdirectories.
+    """
+    return sum(entry.stat().st_size for entry in scan_files(path, recursive=True))
+
+
+def copyfd(src: int, dst: int):
+    """Copy the whole file behind descriptor `src` to descriptor `dst` with
+    ``os.sendfile``, leaving the position of `src` untouched. Return
+    ``False`` without copying anything if the platform or the filesystems
+    involved don't support it.
+    """
+    if not hasattr(os, "sendfile"):  # pragma: no cover
+        return False
+
+    offset = 0
+
+    while True:
+        try:
+            sent = os.sendfile(dst, src, offset, SENDFILE_SIZE)
+        except OSError as e:
+            if offset == 0 and e.errno in (
+                errno.EINVAL,
+                errno.ENOSYS,
+                errno.ENOTSOCK,
+                errno.EOPNOTSUPP,
+            ):
+                return False
+            raise
+
+        if sent == 0:
+            return True
+
+        offset += sent
 
 
 def to_bytes(text: bytes | str):
@@ -448,7 +853,15 @@ def to_bytes(text: bytes | str):
     return text
 
 
-@dataclass
+class HashObject(Protocol):
+    """Part of the ``hashlib`` hash object interface used to feed data to a
+    hash while it is being copied.
+    """
+
+    def update(self, data: bytes, /) -> None: ...
+
+
+@dataclass(slots=True)
 class HashAddress:
     """File address containing file's path on disk and it's content hash ID.
 
@@ -478,23 +891,58 @@ class Stream(object):
     the stream in.
 
     Successive readings of the stream is supported without having to manually
-    set it's position back to ``0``.
+    set it's position back to ``0``. Text streams are encoded as UTF-8, so
+    iterating a stream always yields ``bytes``.
     """
 
-    def __init__(self, obj: BinaryIO | str):
-        if isinstance(obj, str) and os.path.isfile(obj):
-            obj = io.open(obj, "rb")
+    def __init__(self, obj: BinaryIO | TextIO | str):
+        size = None
+        fileno = None
+
+        if isinstance(obj, str):
+            # Open directly instead of probing with os.path.isfile first; a
+            # missing path or a directory fails the open just the same.
+            try:
+                obj = io.open(obj, "rb")
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                raise ValueError(
+                    "Object must be a valid file path or a BinaryIO object"
+                ) from None
             pos = None
-        elif isinstance(obj, BinaryIO):
+        elif hasattr(obj, "read") and hasattr(obj, "seek"):
             pos = obj.tell()
         else:
             raise ValueError("Object must be a valid file path or a BinaryIO object")
 
+        buffer_size = CHUNK_SIZE
+
         try:
-            file_stat = os.stat(obj.name)
-            buffer_size = file_stat.st_blksize
-        except Exception:
-            buffer_size = 8192
+            # fstat the already open descriptor rather than resolving
+            # obj.name through the filesystem a second time.
+            file_stat = os.fstat(obj.fileno())
+        except (AttributeError, OSError):
+            pass
+        else:
+            if stat.S_ISREG(file_stat.st_mode):
+                # Don't allocate more than a regular file needs.
+                buffer_size = min(CHUNK_SIZE, file_stat.st_size) or CHUNK_SIZE
+
+                # Only plain binary files read back exactly what is in the
+                # file behind their descriptor. Wrappers such as gzip, bz2
+                # or text files expose the descriptor of the encoded data.
+                if type(obj) in _PLAIN_FILE_TYPES:
+                    fileno = obj.fileno()
+
+            if pos is None and fileno is not None:
+                size = file_stat.st_size
+
+                if size > buffer_size and hasattr(os, "posix_fadvise"):
+                    # Files we open are read front to back, usually more
+                    # than once, so let the kernel read ahead aggressively.
+                    try:
+                        os.posix_fadvise(obj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    except OSError:  # pragma: no cover
+                        pass
 
         try:
             # Expose the original file path if available.
@@ -507,27 +955,90 @@ class Stream(object):
         except AttributeError:
             self.name = None
 
-        self._obj = obj
+        self._obj: BinaryIO | TextIO = obj
         self._pos = pos
         self._buffer_size = buffer_size
+        self._size = size
+        self._fileno = fileno
 
     def __iter__(self):
         """Read underlying IO object and yield results. Return object to
         original position if we didn't open it originally.
         """
         self._obj.seek(0)
+        read = self._obj.read
+        buffer_size = self._buffer_size
+        single_read = False
+
+        if self._size is not None and self._size <= buffer_size:
+            # Small files we opened ourselves fit in a single chunk; read
+            # them in one go and skip the extra read that only finds EOF.
+            buffer_size = self._size
+            single_read = True
 
         while True:
-            data = self._obj.read(self._buffer_size)
+            data = read(buffer_size)
 
             if not data:
                 break
 
+            if isinstance(data, str):
+                # Encode text once here so that consumers always get bytes
+                # and don't have to type check every chunk themselves.
+                data = data.encode("utf8")
+
             yield data
 
+            if single_read:
+                break
+
         if self._pos is not None:
             self._obj.seek(self._pos)
 
+    def fileno(self):
+        """Return the file descriptor of the underlying file if it is a
+        regular file opened in binary mode, else ``None``. Pending writes of
+        caller owned file objects are flushed first.
+        """
+        if self._fileno is not None and self._pos is not None:
+            self._obj.flush()
+        return self._fileno
+
+    def mmap(self):
+        """Return a read-only memory map of the whole underlying file, or
+        ``None`` if the stream isn't backed by a regular file opened in binary
+        mode, is smaller than :data:`MMAP_THRESHOLD` or can't be mapped. The
+        caller is responsible for closing the map.
+
+        Reading from the map raises ``SIGBUS`` and kills the interpreter if
+        the file is truncated by someone else while the map is in use.
+        """
+        if self._fileno is None:
+            return None
+
+        if self._size is not None:
+            size = self._size
+        else:
+            # Caller owned file objects may hold unflushed writes and may
+            # have changed size since the stream was created.
+            self._obj.flush()
+            size = os.fstat(self._fileno).st_size
+
+        if size < MMAP_THRESHOLD:
+            return None
+
+        try:
+            mapped = mmap.mmap(self._fileno, 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Unsupported by the filesystem, or emptied since it was sized;
+            # let the caller fall back to reading.
+            return None
+
+        if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+        return mapped
+
     def close(self):
         """Close underlying IO object if we opened it, else return it to
         original position.
@@ -560,8 +1071,9 @@ class PutStrategies:
     @staticmethod
     def copy(evercas: EverCas, src_stream: Stream, dst_path: str) -> None:
         """The default copy put strategy, writes the file object to a
-        temporary file on disk and then moves it into place."""
-        shutil.move(evercas.mktempfile(src_stream), dst_path)
+        temporary file in the EverCas staging folder and then renames it into
+        place."""
+        os.replace(evercas.mkstagedfile(src_stream), dst_path)
 
     @classmethod
     def link(cls, evercas: EverCas, src_stream: Stream, dst_path: str) -> None:
@@ -590,6 +1102,9 @@ class PutStrategies:
             # EPERM - the dst filesystem does not support hard links
             # (note EPERM could also be another permissions error; these
             # will be raised again when we try to copy)
+            if e.errno == errno.EEXIST:
+                # Stored concurrently by another put of the same content.
+                return
             if e.errno not in (errno.EMLINK, errno.EXDEV, errno.EPERM):
                 raise
             return cls.copy(evercas, src_stream, dst_path)
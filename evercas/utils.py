@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
-from typing import Any
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
+from operator import itemgetter
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 def compact(items: list[Any]):
@@ -11,16 +17,85 @@ def compact(items: list[Any]):
 
 def issubdir(subpath: str, path: str):
     """Return whether `subpath` is a sub-directory of `path`."""
-    # Append os.sep so that paths like /usr/var2/log doesn't match /usr/var.
-    path = os.path.realpath(path) + os.sep
+    # Compare whole path components so that paths like /usr/var2/log don't
+    # match /usr/var, and so that everything is below the filesystem root.
+    path = os.path.realpath(path)
     subpath = os.path.realpath(subpath)
-    return subpath.startswith(path)
+    try:
+        return subpath != path and os.path.commonpath([subpath, path]) == path
+    except ValueError:
+        # Paths on different drives have no common path.
+        return False
+
+
+def shard(digest: str, depth: int, width: int) -> tuple[str, ...]:
+    # This creates a tuple of `depth` number of tokens with width
+    # `width` from the first part of the id plus the remainder. Tokens that
+    # would fall past the end of a short digest are never sliced, and an
+    # empty remainder is left out, so no empty parts are produced.
+    size = max(depth, 0) * max(width, 0)
+    end = min(size, len(digest))
+    parts = [digest[i : i + width] for i in range(0, end, width)] if end else []
+    tail = digest[size:]
+    if tail:
+        parts.append(tail)
+    return tuple(parts)
+
 
+def make_shard(depth: int, width: int) -> Callable[[str], tuple[str, ...]]:
+    """Return a function equivalent to ``shard(digest, depth, width)`` for
+    fixed `depth` and `width`.
 
-def shard(digest: str, depth: int, width: int):
-    # This creates a list of `depth` number of tokens with width
-    # `width` from the first part of the id plus the remainder.
-    return compact(
-        [digest[i * width : width * (i + 1)] for i in range(depth)]
-        + [digest[depth * width :]]
+    The slice bounds are computed once and applied by a single
+    ``itemgetter`` call, which avoids the per-call loop and arithmetic of
+    :func:`shard`. Digests too short to fill every subfolder fall back to
+    :func:`shard` so that empty components are still dropped.
+    """
+    if depth <= 0 or width <= 0:
+        return partial(shard, depth=depth, width=width)
+
+    size = depth * width
+    getter = itemgetter(
+        *[slice(i * width, width * (i + 1)) for i in range(depth)],
+        slice(size, None),
     )
+
+    def _shard(digest: str) -> tuple[str, ...]:
+        if len(digest) > size:
+            return getter(digest)
+        return shard(digest, depth, width)
+
+    return _shard
+
+
+def imap_unordered(
+    func: Callable[[T], R], items: Iterable[T], max_workers: int | None = None
+) -> Iterator[R]:
+    """Return generator that yields ``func(item)`` for every item of `items`,
+    running up to `max_workers` calls at once in a thread pool.
+
+    Results are yielded as soon as they are ready, so their order is not
+    guaranteed to match `items`. Only a bounded number of items is consumed
+    ahead of the results, so `items` may be a lazy, arbitrarily long
+    iterable. `max_workers` defaults to ``min(32, os.cpu_count() + 4)``.
+    """
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    max_pending = max_workers * 2
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending: set[Future[R]] = set()
+
+        for item in items:
+            pending.add(executor.submit(func, item))
+
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
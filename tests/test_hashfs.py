@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import errno
+import gzip
+import hashlib
 import os
 import os.path
+import pathlib
+import shutil
 import string
-from io import BufferedReader, StringIO
+from contextlib import closing
+from io import BufferedReader, BytesIO, StringIO
 
 import py
 import pytest
 
 import evercas
 from evercas.evercas import PutStrategies, to_bytes
+from evercas.utils import issubdir, make_shard, shard
 
 
 @pytest.fixture
@@ -91,6 +98,25 @@ def assert_file_put(fs, address):
     assert all(len(part) == fs.width for part in dir_parts)
 
 
+def test_evercas_pathlike_root(testpath):
+    fs = evercas.EverCas(pathlib.Path(str(testpath)))
+
+    assert fs.root == os.path.realpath(str(testpath))
+
+
+def test_evercas_algorithm(fs, stringio):
+    assert len(fs.put(stringio).id) == 64
+
+    fs.algorithm = "md5"
+    assert fs.algorithm == "md5"
+    assert len(fs.put(stringio).id) == 32
+
+
+def test_evercas_algorithm_error(testpath):
+    with pytest.raises(ValueError):
+        evercas.EverCas(str(testpath), algorithm="invalid")
+
+
 def test_evercas_put_stringio(fs, stringio):
     address = fs.put(stringio)
 
@@ -118,6 +144,145 @@ def test_evercas_put_file(fs, filepath):
         assert fileobj.read() == to_bytes(filepath.read())
 
 
+def test_evercas_put_fmode(testpath, stringio):
+    fs = evercas.EverCas(str(testpath), fmode=0o640)
+    address = fs.put(stringio)
+
+    assert os.stat(address.abspath).st_mode & 0o777 == 0o640
+    assert list(fs.files()) == [address.abspath]
+
+
+@pytest.mark.parametrize("size", [0, 1, 4096, 3 * 1024 * 1024 + 1])
+@pytest.mark.parametrize("put_strategy", ["copy", "link"])
+def test_evercas_put_sizes(fs, testfile, size, put_strategy):
+    data = os.urandom(size)
+    testfile.write(data, mode="wb")
+
+    address = fs.put(str(testfile), put_strategy=put_strategy)
+
+    assert address.id == hashlib.sha256(data).hexdigest()
+    with open(address.abspath, "rb") as fileobj:
+        assert fileobj.read() == data
+
+
+def test_evercas_computehash_mmap(fs, testfile, monkeypatch):
+    monkeypatch.setattr(evercas.evercas, "MMAP_THRESHOLD", 1)
+    data = os.urandom(10000)
+    testfile.write(data, mode="wb")
+    fs.use_mmap = True
+
+    with open(str(testfile), "rb") as fileobj:
+        for obj in (str(testfile), fileobj):
+            stream = evercas.evercas.Stream(obj)
+            mapped = stream.mmap()
+            assert mapped is not None
+            mapped.close()
+
+            assert fs.computehash(stream) == hashlib.sha256(data).hexdigest()
+            stream.close()
+
+    assert evercas.evercas.Stream(StringIO("foo")).mmap() is None
+
+
+def test_evercas_computehash_mmap_optin(fs, testfile, monkeypatch):
+    monkeypatch.setattr(evercas.evercas, "MMAP_THRESHOLD", 1)
+    data = os.urandom(10000)
+    testfile.write(data, mode="wb")
+    expected = hashlib.sha256(data).hexdigest()
+
+    def unexpected(*args, **kwargs):
+        raise AssertionError("unexpected mmap")
+
+    def unsupported(*args, **kwargs):
+        raise OSError(errno.ENODEV, "mmap not supported")
+
+    with closing(evercas.evercas.Stream(str(testfile))) as stream:
+        monkeypatch.setattr(evercas.evercas.mmap, "mmap", unexpected)
+        assert fs.computehash(stream) == expected
+
+        # Files that can't be mapped are read instead.
+        fs.use_mmap = True
+        monkeypatch.setattr(evercas.evercas.mmap, "mmap", unsupported)
+        assert stream.mmap() is None
+        assert fs.computehash(stream) == expected
+
+
+def test_evercas_put_gzip(fs, testpath):
+    data = os.urandom(2 * 1024 * 1024)
+    path = str(testpath.join("data.gz"))
+
+    with gzip.open(path, "wb") as fileobj:
+        fileobj.write(data)
+
+    expected = hashlib.sha256(data).hexdigest()
+
+    # gzip exposes the descriptor of the compressed file; it must be read
+    # through the decompressing object instead of mapped or copied.
+    with gzip.open(path, "rb") as fileobj:
+        assert fs.put(fileobj, simulate=True).id == expected
+
+        address = fs.put(fileobj)
+        assert address.id == expected
+        with open(address.abspath, "rb") as stored:
+            assert stored.read() == data
+
+        assert fs.put(fileobj, put_strategy="link").id == expected
+
+
+def test_evercas_mktempfile(fs, testfile, testpath):
+    data = os.urandom(100000)
+    testfile.write(data, mode="wb")
+    gzpath = str(testpath.join("data.gz"))
+
+    with gzip.open(gzpath, "wb") as gzobj:
+        gzobj.write(data)
+
+    with open(str(testfile), "rb") as fileobj, gzip.open(gzpath, "rb") as gzobj:
+        fileobj.seek(10)
+
+        for obj in (str(testfile), fileobj, gzobj, StringIO("foo")):
+            stream = evercas.evercas.Stream(obj)
+            tmppath = fs.mktempfile(stream, dir=fs.root)
+            stream.close()
+
+            expected = b"foo" if isinstance(obj, StringIO) else data
+            with open(tmppath, "rb") as tmpfile:
+                assert tmpfile.read() == expected
+            assert os.stat(tmppath).st_mode & 0o777 == fs.fmode
+            os.remove(tmppath)
+
+        assert fileobj.tell() == 10
+
+
+def test_evercas_put_staging_hidden(fs, stringio):
+    stored = fs.put(stringio)
+    listings = []
+
+    class SlowStream(BytesIO):
+        def read(self, size=-1):
+            # Look at the store while the put is still in progress.
+            listings.append(
+                (
+                    list(fs.files()),
+                    fs.count(),
+                    fs.size(),
+                    list(fs.folders()),
+                    list(fs.corrupted()),
+                )
+            )
+            return super().read(size)
+
+    fs.put(SlowStream(b"bar"))
+
+    assert listings
+    for files, count, size, folders, corrupted in listings:
+        assert files == [stored.abspath]
+        assert count == 1
+        assert size == 3
+        assert folders == [os.path.dirname(stored.abspath)]
+        assert corrupted == []
+
+
 def test_evercas_put_duplicate(fs, stringio):
     address_a = fs.put(stringio)
     address_b = fs.put(stringio)
@@ -126,6 +291,13 @@ def test_evercas_put_duplicate(fs, stringio):
     assert address_b.is_duplicate
 
 
+def test_evercas_put_duplicate_no_leftovers(fs, stringio):
+    address = fs.put(stringio)
+    fs.put(stringio)
+
+    assert list(fs.files()) == [address.abspath]
+
+
 @pytest.mark.parametrize("extension", ["txt", ".txt", "md", ".md"])
 def test_evercas_put_extension(fs, stringio, extension):
     address = fs.put(stringio, extension)
@@ -238,6 +410,38 @@ def test_evercas_putdir(fs, testtree, recursive, exp_num_files, extensions):
     assert len(putfiles) == exp_num_files
 
 
+@pytest.mark.parametrize("put_strategy", ["copy", "link"])
+@pytest.mark.parametrize("max_workers", [1, 8])
+def test_evercas_putdir_duplicates(fs, tmpdir, put_strategy, max_workers):
+    srcdir = tmpdir.mkdir("src")
+    for i in range(20):
+        srcdir.join(str(i)).write(b"same contents")
+
+    putfiles = list(
+        fs.putdir(str(srcdir), put_strategy=put_strategy, max_workers=max_workers)
+    )
+
+    assert len(putfiles) == 20
+    assert len({address.id for _, address in putfiles}) == 1
+    assert fs.count() == 1
+
+    if put_strategy == "copy":
+        assert sum(not address.is_duplicate for _, address in putfiles) == 1
+
+
+def test_evercas_put_without_hard_links(fs, stringio, monkeypatch):
+    def link(src, dst):
+        raise PermissionError(errno.EPERM, "Operation not permitted")
+
+    monkeypatch.setattr(os, "link", link)
+
+    address = fs.put(stringio)
+    assert_file_put(fs, address)
+    assert not address.is_duplicate
+    assert fs.put(stringio).is_duplicate
+    assert list(fs.files()) == [address.abspath]
+
+
 @pytest.mark.parametrize(
     "lowercase_extensions",
     [
@@ -299,6 +503,14 @@ def test_evercas_contains(fs, stringio):
     assert address.abspath in fs
 
 
+def test_evercas_get_wildcard_root(tmpdir, stringio):
+    fs = evercas.EverCas(str(tmpdir.mkdir("[evercas]*")))
+    address = fs.put(stringio, ".txt")
+
+    assert fs.get(address.id) == address
+    assert fs.exists(address.id)
+
+
 def test_evercas_get(fs, stringio):
     address = fs.put(stringio)
 
@@ -309,12 +521,102 @@ def test_evercas_get(fs, stringio):
     assert fs.get("invalid") is None
 
 
+def test_evercas_lookup_cache(testpath, stringio, monkeypatch):
+    fs = evercas.EverCas(str(testpath), lookup_cache_size=1)
+    address_a = fs.put(stringio, ".txt")
+    address_b = fs.put(StringIO("bar"))
+
+    assert fs.get(address_a.id) == address_a
+
+    def isfile(path):
+        raise AssertionError("unexpected filesystem lookup")
+
+    with monkeypatch.context() as m:
+        m.setattr(os.path, "isfile", isfile)
+        assert fs.get(address_a.id) == address_a
+
+    assert fs.get(address_b.id) == address_b
+    fs.delete(address_b.id)
+    assert fs.get(address_b.id) is None
+    assert fs.get(address_a.id) == address_a
+
+
+def test_evercas_lookup_cache_delete(testpath, stringio, monkeypatch):
+    fs = evercas.EverCas(str(testpath), lookup_cache_size=2)
+    address_a = fs.put(stringio)
+    address_b = fs.put(StringIO("bar"))
+
+    assert fs.get(address_a.id) == address_a
+    assert fs.get(address_b.id) == address_b
+    fs.delete(address_b.id)
+
+    def isfile(path):
+        raise AssertionError("unexpected filesystem lookup")
+
+    # Deleting one file keeps the other cached ids.
+    with monkeypatch.context() as m:
+        m.setattr(os.path, "isfile", isfile)
+        assert fs.get(address_a.id) == address_a
+
+    assert fs.get(address_b.id) is None
+
+    # Ids cached with their extension are forgotten when deleting by path.
+    address_c = fs.put(StringIO("baz"), extension="txt")
+    assert fs.get(address_c.id + ".txt") == address_c
+    fs.delete(address_c.abspath)
+    assert fs.get(address_c.id + ".txt") is None
+
+
+def test_evercas_lookup_cache_size(fs, stringio, monkeypatch):
+    address_a = fs.put(stringio)
+    address_b = fs.put(StringIO("bar"))
+
+    def isfile(path):
+        raise AssertionError("unexpected filesystem lookup")
+
+    fs.lookup_cache_size = 2
+    assert fs.get(address_a.id) == address_a
+    assert fs.get(address_b.id) == address_b
+
+    with monkeypatch.context() as m:
+        m.setattr(os.path, "isfile", isfile)
+        assert fs.get(address_a.id) == address_a
+        assert fs.get(address_b.id) == address_b
+
+    # Shrinking the cache forgets the least recently used ids.
+    fs.lookup_cache_size = 1
+    with monkeypatch.context() as m:
+        m.setattr(os.path, "isfile", isfile)
+        assert fs.get(address_b.id) == address_b
+        with pytest.raises(AssertionError):
+            fs.get(address_a.id)
+
+    fs.lookup_cache_size = 0
+    assert fs._lookup_cache is None
+    assert fs.get(address_b.id) == address_b
+
+
 @pytest.mark.parametrize("address_attr", ["id", "abspath"])
 def test_evercas_delete(fs, stringio, address_attr):
     address = fs.put(stringio)
 
     fs.delete(getattr(address, address_attr))
-    assert len(os.listdir(fs.root)) == 0
+    assert os.listdir(fs.root) == [evercas.evercas.STAGING_DIRNAME]
+
+
+@pytest.mark.parametrize("put_strategy", ["copy", "link"])
+def test_evercas_put_after_delete(fs, filepath, put_strategy):
+    address = fs.put(str(filepath), put_strategy=put_strategy)
+    fs.delete(address.id)
+    assert not os.path.exists(os.path.dirname(address.abspath))
+
+    address = fs.put(str(filepath), put_strategy=put_strategy)
+    assert_file_put(fs, address)
+
+    # Shard folders removed behind the instance's back are recreated too.
+    shutil.rmtree(os.path.join(fs.root, address.relpath.split(os.sep)[0]))
+    address = fs.put(str(filepath), put_strategy=put_strategy)
+    assert_file_put(fs, address)
 
 
 def test_evercas_delete_error(fs):
@@ -342,6 +644,34 @@ def test_evercas_remove_empty(fs):
     assert not os.path.exists(subpath3)
 
 
+def test_evercas_remove_empty_symlink(fs, tmpdir):
+    target = str(tmpdir.mkdir("target"))
+    link = os.path.join(fs.root, "1", "link")
+
+    fs.makepath(os.path.dirname(link))
+    os.symlink(target, link)
+
+    fs.remove_empty(link)
+
+    assert os.path.islink(link)
+    assert os.path.isdir(target)
+
+
+def test_evercas_remove_empty_through_symlink(fs, tmpdir):
+    target = str(tmpdir.mkdir("outside"))
+    victim = os.path.join(target, "victim")
+    os.mkdir(victim)
+    link = os.path.join(fs.root, "link")
+
+    fs.makepath(fs.root)
+    os.symlink(target, link)
+
+    fs.remove_empty(os.path.join(link, "victim"))
+
+    assert os.path.isdir(victim)
+    assert os.path.islink(link)
+
+
 def test_evercas_remove_empty_subdir(fs):
     fs.remove_empty(fs.root)
 
@@ -352,6 +682,28 @@ def test_evercas_remove_empty_subdir(fs):
     assert os.path.exists(fs.root)
 
 
+def test_evercas_haspath(fs):
+    assert fs.haspath(os.path.join(fs.root, "a", "b"))
+    assert fs.haspath(os.path.join(fs.root, "a", "..", "b"))
+    assert not fs.haspath(fs.root)
+    assert not fs.haspath(os.path.join(fs.root, "..", "b"))
+    assert not fs.haspath(os.path.join(fs.root, "a", "..", "..", "b"))
+    assert not fs.haspath(fs.root + "b")
+
+
+def test_evercas_haspath_symlink(fs, tmpdir):
+    target = tmpdir.mkdir("outside")
+    target.join("x").write(b"outside")
+    link = os.path.join(fs.root, "link")
+
+    fs.makepath(fs.root)
+    os.symlink(str(target), link)
+
+    assert not fs.haspath(os.path.join(link, "x"))
+    with pytest.raises(ValueError):
+        fs.get(os.path.join(link, "x"))
+
+
 def test_evercas_unshard(fs, stringio):
     address = fs.put(stringio)
     assert fs.unshard(address.abspath) == address.id
@@ -391,6 +743,21 @@ def test_evercas_repair_duplicates(fs, stringio):
     assert_file_put(newfs, address)
 
 
+@pytest.mark.parametrize("max_workers", [None, 1, 3])
+def test_evercas_repair_many(fs, max_workers):
+    count = 10
+    addresses = put_range(fs, count)
+    newfs = evercas.EverCas(fs.root, depth=1)
+
+    repaired = newfs.repair(max_workers=max_workers)
+
+    assert sorted(path for path, _ in repaired) == sorted(addresses)
+    for original_path, address in repaired:
+        assert addresses[original_path].id == address.id
+        assert_file_put(newfs, address)
+    assert list(newfs.corrupted()) == []
+
+
 def test_evercas_files(fs):
     count = 5
     addresses = put_range(fs, count)
@@ -444,9 +811,63 @@ def test_evercas_folders(fs):
         assert os.path.isfile(os.path.join(folder, os.listdir(folder)[0]))
 
 
+def test_evercas_empty(tmpdir):
+    fs = evercas.EverCas(str(tmpdir.join("missing")))
+
+    assert list(fs.files()) == []
+    assert fs.count() == 0
+    assert fs.size() == 0
+
+
 def test_evercas_size(fs):
     fs.put(StringIO("{0}".format(string.ascii_lowercase)))
     fs.put(StringIO("{0}".format(string.ascii_uppercase)))
     expected = len(string.ascii_lowercase) + len(string.ascii_uppercase)
 
     assert fs.size() == expected
+    assert fs.size(max_workers=1) == expected
+
+
+@pytest.mark.parametrize(
+    "digest,depth,width,expected",
+    [
+        ("", 4, 1, ()),
+        ("abc", 0, 1, ("abc",)),
+        ("abc", 1, 0, ("abc",)),
+        ("abc", 4, 1, ("a", "b", "c")),
+        ("abcd", 4, 1, ("a", "b", "c", "d")),
+        ("abcde", 2, 2, ("ab", "cd", "e")),
+        ("abcdef", 2, 2, ("ab", "cd", "ef")),
+        ("abcde", 3, 2, ("ab", "cd", "e")),
+    ],
+)
+def test_shard(digest, depth, width, expected):
+    assert shard(digest, depth, width) == expected
+
+
+@pytest.mark.parametrize("depth,width", [(0, 1), (1, 0), (1, 1), (4, 1), (3, 2)])
+@pytest.mark.parametrize("digest", ["", "a", "abc", "abcdef", "abcdef0123456789"])
+def test_make_shard(depth, width, digest):
+    assert make_shard(depth, width)(digest) == shard(digest, depth, width)
+
+
+def test_evercas_depth_width(fs, stringio):
+    fs.depth = 2
+    fs.width = 3
+    address = fs.put(stringio)
+
+    assert_file_put(fs, address)
+
+
+@pytest.mark.parametrize(
+    "subpath,path,expected",
+    [
+        ("/usr/var/log", "/usr/var", True),
+        ("/usr/var2/log", "/usr/var", False),
+        ("/usr/var", "/usr/var", False),
+        ("/usr", "/usr/var", False),
+        ("/usr/var", "/", True),
+    ],
+)
+def test_issubdir(subpath, path, expected):
+    assert issubdir(subpath, path) is expected